@@ -1,27 +1,98 @@
-
 import os
+import time
+import importlib
+
+_import_started = time.perf_counter()
+# Heavy imports are timed one by one so the startup log shows where import time
+# goes; each figure only covers what a module pulls in beyond the imports before it
+_startup_import_ms = {}
+
+
+def timed_import(module_name, optional=False):
+    started = time.perf_counter()
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError:
+        if not optional:
+            raise
+        return None
+    _startup_import_ms[module_name] = round((time.perf_counter() - started) * 1000, 1)
+    return module
+
+
 import logging
-import streamlit as st
-import streamlit_authenticator as stauth
-import pyotp
-import yaml
 import io
+import copy
+import gzip
+import queue
+import hashlib
+import base64
+import codecs
+import contextlib
 import uuid
-import qrcode
-import json
+import atexit
+import random
+import types
+import threading
 import datetime
-import PyPDF2
-import docx
-from azure.storage.blob import BlobServiceClient
-from openai import AzureOpenAI
+st = timed_import("streamlit")
+stauth = timed_import("streamlit_authenticator")
+yaml = timed_import("yaml")
+cachetools = timed_import("cachetools")
+orjson = timed_import("orjson")
+asyncio = timed_import("asyncio")
+sqlite3 = timed_import("sqlite3")
+openai = timed_import("openai")
+zstandard = timed_import("zstandard", optional=True)
+timed_import("azure.storage.blob")
+timed_import("dotenv")
+from concurrent.futures import ThreadPoolExecutor
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    ClientAuthenticationError,
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+    ResourceNotModifiedError,
+)
+from azure.storage.blob import BlobServiceClient, StandardBlobTier
+from openai import AsyncAzureOpenAI, AzureOpenAI
 from yaml.loader import SafeLoader
 from dotenv import load_dotenv
 
+_import_elapsed_ms = (time.perf_counter() - _import_started) * 1000
+
+
+class LazyModule(types.ModuleType):
+    # Stands in for a module until one of its attributes is first used
+    def __init__(self, name):
+        super().__init__(name)
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            started = time.perf_counter()
+            self._module = importlib.import_module(self.__name__)
+            record_import_time(self.__name__, (time.perf_counter() - started) * 1000)
+        return getattr(self._module, attr)
+
+
+# Only needed for document uploads, first-time OTP setup, token counting and embeddings
+docx = LazyModule("docx")
+qrcode = LazyModule("qrcode")
+pyotp = LazyModule("pyotp")
+tiktoken = LazyModule("tiktoken")
+np = LazyModule("numpy")
+faiss = LazyModule("faiss")
+text_splitters = LazyModule("langchain_text_splitters")
+pdf_extraction = LazyModule("pdf_extraction")
+
 load_dotenv()
 
 # Set up logging
 logging.basicConfig(
-    level=logging.ERROR,
+    level=os.getenv("LOG_LEVEL", "ERROR").upper(),
     format='%(asctime)s %(levelname)s %(message)s'
 )
 
@@ -36,30 +107,490 @@ st.set_page_config(
     initial_sidebar_state="auto"
 )
 
+@st.cache_resource(show_spinner=False)
+def get_import_report():
+    return {}
+
+
+def record_import_time(module_name, elapsed_ms):
+    # Keep the first (cold) measurement; later reruns hit sys.modules
+    report = get_import_report()
+    if module_name not in report:
+        report[module_name] = round(elapsed_ms, 1)
+        logging.info(f"Imported {module_name} in {report[module_name]} ms")
+
+
+if not get_import_report():
+    get_import_report().update(_startup_import_ms)
+    slowest = sorted(_startup_import_ms.items(), key=lambda item: item[1], reverse=True)
+    logging.info(f"Startup imports took {_import_elapsed_ms:.1f} ms: "
+                 + ", ".join(f"{module_name} {elapsed_ms} ms" for module_name, elapsed_ms in slowest))
+
+# Shared clients are cached once per process (keyed by their credentials) so that
+# every session and every rerun reuses the same HTTP connection pools
+OPENAI_API_VERSION = "2024-04-01-preview"
+CLIENT_HEALTH_CHECK_INTERVAL = int(os.getenv("CLIENT_HEALTH_CHECK_INTERVAL", "300"))
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key, endpoint, api_version):
+    return AzureOpenAI(
+        api_key=api_key,
+        azure_endpoint=endpoint,
+        api_version=api_version,
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_async_openai_client(api_key, endpoint, api_version):
+    return AsyncAzureOpenAI(
+        api_key=api_key,
+        azure_endpoint=endpoint,
+        api_version=api_version,
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_blob_service_client(connection_string):
+    return BlobServiceClient.from_connection_string(connection_string)
+
+
+@st.cache_resource(show_spinner=False)
+def get_client_health():
+    return {"last_checked": 0.0, "lock": threading.Lock()}
+
+
+def reload_credentials():
+    # Pick up rotated secrets from the environment / .env file
+    load_dotenv(override=True)
+    return (
+        os.getenv("OPENAI_API_KEY_AZURE"),
+        os.getenv("OPENAI_ENDPOINT_AZURE"),
+        os.getenv("BLOB_CONNECTION_STRING"),
+    )
+
+
+def reset_openai_client():
+    get_openai_client.clear()
+    get_async_openai_client.clear()
+    api_key, endpoint, _ = reload_credentials()
+    return get_openai_client(api_key, endpoint, OPENAI_API_VERSION)
+
+
+def ensure_blob_service_client(connection_string, container_name):
+    # Health-check the pooled client at most once per interval and rebuild it
+    # with freshly loaded credentials when the current ones are rejected
+    service_client = get_blob_service_client(connection_string)
+    health = get_client_health()
+    if time.monotonic() - health["last_checked"] < CLIENT_HEALTH_CHECK_INTERVAL:
+        return service_client
+
+    with health["lock"]:
+        if time.monotonic() - health["last_checked"] < CLIENT_HEALTH_CHECK_INTERVAL:
+            return service_client
+        try:
+            service_client.get_container_client(container_name).get_container_properties()
+        except ClientAuthenticationError as e:
+            logging.error(f"Blob Client Health Check Error: {e}")
+            get_blob_service_client.clear()
+            _, _, connection_string = reload_credentials()
+            service_client = get_blob_service_client(connection_string)
+        except HttpResponseError as e:
+            logging.error(f"Blob Client Health Check Error: {e}")
+        health["last_checked"] = time.monotonic()
+    return service_client
+
+
 # Initialize the Azure OpenAI client with error handling
 try:
-    client = AzureOpenAI(
-        api_key=azure_openai_api_key,
-        azure_endpoint=azure_endpoint,
-        api_version="2024-04-01-preview",
-    )
+    client = get_openai_client(azure_openai_api_key, azure_endpoint, OPENAI_API_VERSION)
 except Exception as e:
     st.error("Failed to initialize Azure OpenAI client.")
     logging.error(f"OpenAI Client Initialization Error: {e}")
     st.stop()
 
-# Load config from Azure Blob Storage
-connection_string = os.getenv("BLOB_CONNECTION_STRING")
-container_name = "itgluecopilot"
+# All persistence goes through a storage backend selected with STORAGE_BACKEND:
+# Azure Blob Storage (default), a local directory or a SQLite database. The
+# latter two let the app, load tests and benchmarks run fully offline. Objects
+# live in named stores (config, conversations, uploaded documents) and carry an
+# opaque ETag used for conditional reads and writes.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "azure").lower()
+LOCAL_STORAGE_PATH = os.getenv("LOCAL_STORAGE_PATH", "./storage")
+SQLITE_STORAGE_PATH = os.getenv("SQLITE_STORAGE_PATH", "./synoptekgpt.db")
+CONFIG_STORE = "itgluecopilot"
+CONVERSATION_STORE = "test-container"
+DOCUMENT_STORE = os.getenv("DOCUMENT_STORE", "documents")
+
+
+class NotModifiedError(Exception):
+    pass
+
+
+class ConflictError(Exception):
+    pass
+
+
+class AzureBlobStorage:
+    def __init__(self, service_client):
+        self.service_client = service_client
+
+    def blob(self, store, name):
+        return self.service_client.get_blob_client(container=store, blob=name)
+
+    def read(self, store, name, etag=None):
+        # Returns (data, etag), (None, None) when missing; raises NotModifiedError
+        # when `etag` is given and still current
+        try:
+            if etag:
+                downloader = self.blob(store, name).download_blob(etag=etag, match_condition=MatchConditions.IfModified)
+            else:
+                downloader = self.blob(store, name).download_blob()
+            return downloader.readall(), downloader.properties.etag
+        except ResourceNotModifiedError:
+            raise NotModifiedError(name)
+        except ResourceNotFoundError:
+            return None, None
+
+    def write(self, store, name, data, etag=None, tier=None):
+        # etag=None overwrites unconditionally, "*" only creates, anything else
+        # must match the stored ETag; returns the new ETag
+        # The SDK needs the enum; it calls .value on whatever it is given
+        options = {"standard_blob_tier": StandardBlobTier(tier)} if tier else {}
+        if etag == "*":
+            options["overwrite"] = False
+        elif etag:
+            options.update(overwrite=True, etag=etag, match_condition=MatchConditions.IfNotModified)
+        else:
+            options["overwrite"] = True
+        blob_client = self.blob(store, name)
+        try:
+            try:
+                result = blob_client.upload_blob(data, **options)
+            except ResourceNotFoundError as e:
+                # Stores such as DOCUMENT_STORE are created on their first write
+                if e.error_code != "ContainerNotFound":
+                    raise
+                self.create_store(store)
+                result = blob_client.upload_blob(data, **options)
+        except (ResourceModifiedError, ResourceExistsError) as e:
+            raise ConflictError(name) from e
+        return result.get("etag")
+
+    def create_store(self, store):
+        try:
+            self.service_client.create_container(store)
+            logging.info(f"Created blob container {store}")
+        except ResourceExistsError:
+            pass
+
+    def append(self, store, name, data):
+        # Returns the number of blocks appended so far
+        blob_client = self.blob(store, name)
+        try:
+            result = blob_client.append_block(data)
+        except ResourceNotFoundError:
+            try:
+                blob_client.create_append_blob(etag="*", match_condition=MatchConditions.IfMissing)
+            except ResourceExistsError:
+                pass
+            result = blob_client.append_block(data)
+        return result.get("blob_committed_block_count", 0)
+
+    def delete(self, store, name, etag=None):
+        try:
+            if etag:
+                self.blob(store, name).delete_blob(etag=etag, match_condition=MatchConditions.IfNotModified)
+            else:
+                self.blob(store, name).delete_blob()
+        except ResourceNotFoundError:
+            pass
+        except ResourceModifiedError as e:
+            raise ConflictError(name) from e
+
+
+class LocalFileStorage:
+    # One file per object under <root>/<store>/<name>; the ETag is a content
+    # hash. Conditional writes are atomic within this process.
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.block_counts = {}
+
+    def path(self, store, name):
+        return os.path.join(self.root, store, *name.split("/"))
+
+    def current(self, path):
+        if not os.path.exists(path):
+            return None, None
+        with open(path, "rb") as f:
+            data = f.read()
+        return data, hashlib.sha256(data).hexdigest()
+
+    def read(self, store, name, etag=None):
+        with self.lock:
+            data, current_etag = self.current(self.path(store, name))
+        if etag and data is not None and etag == current_etag:
+            raise NotModifiedError(name)
+        return data, current_etag
+
+    def write(self, store, name, data, etag=None, tier=None):
+        path = self.path(store, name)
+        with self.lock:
+            _, current_etag = self.current(path)
+            if (etag == "*" and current_etag) or (etag not in (None, "*") and etag != current_etag):
+                raise ConflictError(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            self.block_counts.pop(path, None)
+        return hashlib.sha256(data).hexdigest()
+
+    def append(self, store, name, data):
+        path = self.path(store, name)
+        with self.lock:
+            if path not in self.block_counts:
+                existing, _ = self.current(path)
+                self.block_counts[path] = existing.count(b"\n") if existing else 0
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "ab") as f:
+                f.write(data)
+            self.block_counts[path] += 1
+            return self.block_counts[path]
+
+    def delete(self, store, name, etag=None):
+        path = self.path(store, name)
+        with self.lock:
+            _, current_etag = self.current(path)
+            if current_etag is None:
+                return
+            if etag and etag != current_etag:
+                raise ConflictError(name)
+            os.remove(path)
+            self.block_counts.pop(path, None)
+
+
+class SQLiteStorage:
+    # A single table in WAL mode, one connection per thread
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connect().execute(
+            "CREATE TABLE IF NOT EXISTS objects ("
+            "store TEXT NOT NULL, name TEXT NOT NULL, data BLOB NOT NULL, "
+            "etag TEXT NOT NULL, blocks INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (store, name))"
+        )
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def read(self, store, name, etag=None):
+        row = self.connect().execute(
+            "SELECT data, etag FROM objects WHERE store = ? AND name = ?", (store, name)
+        ).fetchone()
+        if row is None:
+            return None, None
+        if etag and etag == row[1]:
+            raise NotModifiedError(name)
+        return bytes(row[0]), row[1]
+
+    def write(self, store, name, data, etag=None, tier=None):
+        conn = self.connect()
+        new_etag = uuid.uuid4().hex
+        if etag == "*":
+            try:
+                conn.execute(
+                    "INSERT INTO objects (store, name, data, etag) VALUES (?, ?, ?, ?)",
+                    (store, name, data, new_etag),
+                )
+            except sqlite3.IntegrityError as e:
+                raise ConflictError(name) from e
+        elif etag:
+            cursor = conn.execute(
+                "UPDATE objects SET data = ?, etag = ?, blocks = 0 WHERE store = ? AND name = ? AND etag = ?",
+                (data, new_etag, store, name, etag),
+            )
+            if cursor.rowcount == 0:
+                raise ConflictError(name)
+        else:
+            conn.execute(
+                "INSERT INTO objects (store, name, data, etag) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (store, name) DO UPDATE SET data = excluded.data, etag = excluded.etag, blocks = 0",
+                (store, name, data, new_etag),
+            )
+        return new_etag
+
+    def append(self, store, name, data):
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO objects (store, name, data, etag, blocks) VALUES (?, ?, ?, ?, 1) "
+                "ON CONFLICT (store, name) DO UPDATE SET "
+                "data = CAST(data || excluded.data AS BLOB), etag = excluded.etag, blocks = blocks + 1",
+                (store, name, data, uuid.uuid4().hex),
+            )
+            blocks = conn.execute(
+                "SELECT blocks FROM objects WHERE store = ? AND name = ?", (store, name)
+            ).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return blocks
+
+    def delete(self, store, name, etag=None):
+        conn = self.connect()
+        if etag:
+            cursor = conn.execute(
+                "DELETE FROM objects WHERE store = ? AND name = ? AND etag = ?", (store, name, etag)
+            )
+            if cursor.rowcount == 0 and self.read(store, name)[0] is not None:
+                raise ConflictError(name)
+        else:
+            conn.execute("DELETE FROM objects WHERE store = ? AND name = ?", (store, name))
+
+
+@st.cache_resource(show_spinner=False)
+def get_storage_metrics():
+    return {"operations": {}, "lock": threading.Lock()}
+
+
+class MeteredStorage:
+    # Records per-operation latency so backends can be compared under load
+    def __init__(self, backend):
+        self.backend = backend
+        self.backend_name = type(backend).__name__
+
+    @contextlib.contextmanager
+    def measure(self, operation):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            metrics = get_storage_metrics()
+            with metrics["lock"]:
+                stats = metrics["operations"].setdefault((self.backend_name, operation), {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+                stats["count"] += 1
+                stats["total_ms"] += elapsed_ms
+                stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+                if stats["count"] % 500 == 0:
+                    logging.info(f"Storage {self.backend_name}.{operation}: {stats['count']} calls, "
+                                 f"avg {stats['total_ms'] / stats['count']:.1f} ms, max {stats['max_ms']:.1f} ms")
+
+    def read(self, store, name, etag=None):
+        with self.measure("read"):
+            return self.backend.read(store, name, etag)
+
+    def write(self, store, name, data, etag=None, tier=None):
+        with self.measure("write"):
+            return self.backend.write(store, name, data, etag, tier)
+
+    def append(self, store, name, data):
+        with self.measure("append"):
+            return self.backend.append(store, name, data)
+
+    def delete(self, store, name, etag=None):
+        with self.measure("delete"):
+            return self.backend.delete(store, name, etag)
+
+
+@st.cache_resource(show_spinner=False)
+def get_local_storage(root):
+    return LocalFileStorage(root)
+
+
+@st.cache_resource(show_spinner=False)
+def get_sqlite_storage(path):
+    return SQLiteStorage(path)
+
+
+def get_storage():
+    if STORAGE_BACKEND == "local":
+        return MeteredStorage(get_local_storage(LOCAL_STORAGE_PATH))
+    if STORAGE_BACKEND == "sqlite":
+        return MeteredStorage(get_sqlite_storage(SQLITE_STORAGE_PATH))
+    if STORAGE_BACKEND == "azure":
+        connection_string = os.getenv("BLOB_CONNECTION_STRING")
+        return MeteredStorage(AzureBlobStorage(ensure_blob_service_client(connection_string, CONFIG_STORE)))
+    raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+
+
+try:
+    storage = get_storage()
+except Exception as e:
+    st.error("Failed to initialize storage.")
+    logging.error(f"Storage Initialization Error: {e}")
+    st.stop()
+
 config_blob_name = "config/config_quad.yaml"
 
-blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-container_client = blob_service_client.get_container_client(container_name)
+# The parsed config is kept in process memory and only revalidated against the
+# stored ETag (conditional GET) once the TTL has expired
+CONFIG_CACHE_TTL = int(os.getenv("CONFIG_CACHE_TTL_SECONDS", "300"))
+
+
+@st.cache_resource(show_spinner=False)
+def get_config_cache():
+    return {"config": None, "etag": None, "fetched_at": 0.0, "lock": threading.Lock()}
+
+
+def load_config():
+    cache = get_config_cache()
+    with cache["lock"]:
+        if cache["config"] is not None and time.monotonic() - cache["fetched_at"] < CONFIG_CACHE_TTL:
+            return copy.deepcopy(cache["config"])
+        try:
+            cached_etag = cache["etag"] if cache["config"] is not None else None
+            config_data, etag = storage.read(CONFIG_STORE, config_blob_name, etag=cached_etag)
+            cache["config"] = yaml.load(io.BytesIO(config_data), Loader=SafeLoader)
+            cache["etag"] = etag
+        except NotModifiedError:
+            pass
+        except Exception as e:
+            # Keep serving the last good copy; try again once the TTL expires
+            if cache["config"] is None:
+                raise
+            logging.error(f"Config Revalidation Error: {e}")
+        cache["fetched_at"] = time.monotonic()
+        return copy.deepcopy(cache["config"])
+
+
+def update_config(mutate):
+    # Writes mutate(config) only if the stored config still matches the cached
+    # ETag; on a conflict the stored copy is re-read and mutate applied again, so
+    # concurrent updates from other workers are never overwritten. Write-through
+    # so this process never serves the stale copy after an update.
+    cache = get_config_cache()
+    with cache["lock"]:
+        config, etag = copy.deepcopy(cache["config"]), cache["etag"]
+        for attempt in range(SAVE_MAX_RETRIES):
+            updated = mutate(config)
+            try:
+                new_etag = storage.write(CONFIG_STORE, config_blob_name, yaml.dump(updated).encode("utf-8"), etag=etag or "*")
+            except ConflictError:
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+                config_data, etag = storage.read(CONFIG_STORE, config_blob_name)
+                config = yaml.load(io.BytesIO(config_data), Loader=SafeLoader)
+                continue
+            cache["config"] = copy.deepcopy(updated)
+            cache["etag"] = new_etag
+            cache["fetched_at"] = time.monotonic()
+            return updated
+    raise RuntimeError(f"Gave up on {config_blob_name} after {SAVE_MAX_RETRIES} conflicting writes")
+
 
 # Load the YAML configuration file
-blob_client = container_client.get_blob_client(config_blob_name)
-blob_data = blob_client.download_blob().readall()
-config = yaml.load(io.BytesIO(blob_data), Loader=SafeLoader)
+config = load_config()
 
 # Initialize the authenticator
 authenticator = stauth.Authenticate(
@@ -69,6 +600,1260 @@ authenticator = stauth.Authenticate(
     config['cookie']['expiry_days'],
 )
 
+# Stored documents are orjson-encoded and framed with a small versioned header
+# (magic, format version, codec) so the codec can change without a migration.
+# Blobs without the header are the original pretty-printed JSON and still load.
+SERIALIZER_MAGIC = b"SGC"
+SERIALIZER_VERSION = 1
+SERIALIZER_CODECS = {"none": 0, "gzip": 1, "zstd": 2}
+STORAGE_CODEC = os.getenv("STORAGE_CODEC", "gzip").lower()
+# zstandard is optional (imported at the top); without it zstd falls back to gzip
+
+if STORAGE_CODEC not in SERIALIZER_CODECS:
+    logging.warning(f"Unknown STORAGE_CODEC {STORAGE_CODEC!r}, falling back to gzip")
+    STORAGE_CODEC = "gzip"
+
+
+def serialize(obj, codec=None):
+    codec = codec or STORAGE_CODEC
+    if codec == "zstd" and zstandard is None:
+        codec = "gzip"
+    payload = orjson.dumps(obj)
+    if codec == "gzip":
+        payload = gzip.compress(payload, compresslevel=6)
+    elif codec == "zstd":
+        payload = zstandard.ZstdCompressor().compress(payload)
+    return SERIALIZER_MAGIC + bytes([SERIALIZER_VERSION, SERIALIZER_CODECS[codec]]) + payload
+
+
+def deserialize(data):
+    if not data.startswith(SERIALIZER_MAGIC):
+        return orjson.loads(data)
+    version, codec = data[3], data[4]
+    if version != SERIALIZER_VERSION:
+        raise ValueError(f"Unsupported serializer version {version}")
+    payload = data[5:]
+    if codec == SERIALIZER_CODECS["gzip"]:
+        payload = gzip.decompress(payload)
+    elif codec == SERIALIZER_CODECS["zstd"]:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this blob")
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    return orjson.loads(payload)
+
+
+# Conversations are stored as one blob per conversation under a per-user prefix,
+# plus a small per-user index blob that the sidebar lists
+DEFAULT_MODEL = "gpt-4o"
+
+
+# tiktoken downloads its encoding files on first use. For offline deployments,
+# set TIKTOKEN_CACHE_DIR to a folder shipped with the app that already holds them
+# (populate it once on a connected machine with the same variable set). If the
+# encoding can't be loaded, None is cached so each process tries and logs once,
+# and token counts fall back to an estimate.
+@st.cache_resource(show_spinner=False)
+def get_token_encoding(model):
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.error(f"Token Encoding Error: {e}; falling back to estimated token counts")
+        return None
+
+
+def count_message_tokens(message, encoding):
+    # Per-message framing overhead as documented for the chat completions format
+    return 3 + len(encoding.encode(message["role"])) + len(encoding.encode(message["content"] or ""))
+
+
+def get_token_counter(model=DEFAULT_MODEL):
+    # Counts are memoized on the message itself under message["tokens"][<encoding>]
+    # and persisted with it, so every message is tokenized once
+    encoding = get_token_encoding(model)
+    if encoding is not None:
+        encoding_name = encoding.name
+        count = lambda message: count_message_tokens(message, encoding)
+    else:
+        # Fall back to the ~4 characters per token rule of thumb
+        encoding_name = "estimate"
+        count = lambda message: 4 + len(message["content"] or "") // 4
+
+    def count_tokens(message):
+        tokens = message.setdefault("tokens", {})
+        if encoding_name not in tokens:
+            tokens[encoding_name] = count(message)
+        return tokens[encoding_name]
+
+    return count_tokens
+
+
+def to_api_messages(messages):
+    # The chat completions API rejects unknown message fields such as "tokens"
+    return [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+
+
+def count_conversation_tokens(conversation, model=DEFAULT_MODEL):
+    count_tokens = get_token_counter(model)
+    return sum(count_tokens(msg) for msg in conversation)
+
+
+# Requests are fitted into the model's context window, leaving room for the
+# reply: system prompts and the latest exchange are always kept and the oldest
+# turns are dropped first
+MAX_RESPONSE_TOKENS = 4000
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4-32k": 32768,
+    "gpt-4": 8192,
+    "gpt-35-turbo-16k": 16385,
+    "gpt-35-turbo": 16385,
+}
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0"))
+
+
+def get_context_budget(model, max_tokens=MAX_RESPONSE_TOKENS):
+    budget = MODEL_CONTEXT_WINDOWS.get(model, 8192) - max_tokens - 3  # 3 tokens prime the reply
+    return min(budget, CONTEXT_TOKEN_BUDGET) if CONTEXT_TOKEN_BUDGET else budget
+
+
+def truncate_message(message, max_message_tokens, model):
+    encoding = get_token_encoding(model)
+    if encoding is not None:
+        content = encoding.decode(encoding.encode(message["content"])[:max(0, max_message_tokens - 8)])
+    else:
+        content = message["content"][:max(0, max_message_tokens - 8) * 4]
+    return {"role": message["role"], "content": content}
+
+
+def fit_messages_to_context(messages, model, max_tokens=MAX_RESPONSE_TOKENS, reserve_tokens=0, total_tokens=None):
+    budget = get_context_budget(model, max_tokens) - reserve_tokens
+    if total_tokens is not None and total_tokens <= budget:
+        return list(messages)  # Known to fit from the running total
+    count_tokens = get_token_counter(model)
+
+    system = [msg for msg in messages if msg["role"] == "system"]
+    history = [msg for msg in messages if msg["role"] != "system"]
+    # The latest exchange (question, reply, follow-up) is pinned whole when it fits,
+    # so the request never starts with a reply whose question was trimmed away
+    pinned = history[-1:]
+    if len(history) > 2 and history[-2]["role"] == "assistant" and history[-3]["role"] == "user":
+        exchange = history[-3:]
+        if sum(count_tokens(msg) for msg in exchange) <= budget:
+            pinned = exchange
+    older = history[:len(history) - len(pinned)]
+
+    used = sum(count_tokens(msg) for msg in system + pinned)
+    if used > budget and system:
+        # Only the system prompt (e.g. a large document) can give way here
+        overflow = used - budget
+        last = system[-1]
+        system[-1] = truncate_message(last, count_tokens(last) - overflow, model)
+        used = sum(count_tokens(msg) for msg in system + pinned)
+
+    kept = []
+    for msg in reversed(older):
+        cost = count_tokens(msg)
+        if used + cost > budget:
+            break
+        kept.append(msg)
+        used += cost
+    kept.reverse()
+    while kept and kept[0]["role"] != "user":
+        kept.pop(0)  # Don't start the history with an orphaned reply
+
+    if len(kept) < len(older):
+        logging.info(f"Trimmed {len(older) - len(kept)} older messages to fit {budget} tokens")
+    return system + kept + pinned
+
+
+def get_conversation_title(conversation):
+    for msg in conversation["messages"]:
+        if msg["role"] == "user":
+            title = msg["content"].strip()
+            return title[:28] + "..." if len(title) > 28 else title
+    return "Untitled Conversation"
+
+
+def conversation_blob_name(username, conversation_id):
+    return f"conversations/{username}/{conversation_id}.json"
+
+
+def conversation_log_name(username, conversation_id):
+    return f"conversations/{username}/{conversation_id}.log.jsonl"
+
+
+def conversation_summary_name(username, conversation_id):
+    return f"conversations/{username}/{conversation_id}.summary.json"
+
+
+def archive_index_blob_name(username):
+    return f"conversations/{username}/archive_index.json"
+
+
+def index_blob_name(username):
+    return f"conversations/{username}/index.json"
+
+
+# The sidebar reads each user's index from process memory; the blob is only
+# revalidated (conditional GET on its ETag) once the TTL has expired
+CONVERSATION_INDEX_CACHE_TTL = int(os.getenv("CONVERSATION_INDEX_CACHE_TTL", "60"))
+
+
+@st.cache_resource(show_spinner=False)
+def get_index_cache():
+    return {"indexes": {}, "lock": threading.Lock()}
+
+
+def cache_conversation_index(username, index, etag=None):
+    cache = get_index_cache()
+    with cache["lock"]:
+        cached = cache["indexes"].get(username)
+        cache["indexes"][username] = {
+            "index": copy.deepcopy(index),
+            "etag": etag or (cached["etag"] if cached else None),
+            "fetched_at": time.monotonic(),
+        }
+
+
+def load_conversation_index(username):
+    cache = get_index_cache()
+    with cache["lock"]:
+        cached = cache["indexes"].get(username)
+    if cached and time.monotonic() - cached["fetched_at"] < CONVERSATION_INDEX_CACHE_TTL:
+        return copy.deepcopy(cached["index"])
+
+    try:
+        blob_data, etag = storage.read(CONVERSATION_STORE, index_blob_name(username), etag=cached["etag"] if cached else None)
+        index = deserialize(blob_data) if blob_data else []
+        cache_conversation_index(username, index, etag)
+        return index
+    except NotModifiedError:
+        cache_conversation_index(username, cached["index"])
+        return copy.deepcopy(cached["index"])
+    except Exception as e:
+        st.error("Failed to load conversations.")
+        logging.error(f"Load Conversations Error: {e}")
+        return []
+
+
+# Saves are read-modify-write cycles guarded by the blob ETag: a concurrent
+# writer makes the upload fail, and the change is re-applied on a fresh read
+SAVE_MAX_RETRIES = int(os.getenv("SAVE_MAX_RETRIES", "5"))
+
+
+@st.cache_resource(show_spinner=False)
+def get_save_metrics():
+    return {"writes": 0, "conflicts": 0, "exhausted": 0, "lock": threading.Lock()}
+
+
+def record_save_metric(name):
+    metrics = get_save_metrics()
+    with metrics["lock"]:
+        metrics[name] += 1
+        attempts = metrics["writes"] + metrics["conflicts"]
+        conflict_rate = metrics["conflicts"] / attempts if attempts else 0.0
+    if name != "writes":
+        logging.warning(f"Conversation save {name} (conflict rate {conflict_rate:.1%} over {attempts} attempts)")
+
+
+def update_blob(store, name, mutate):
+    for attempt in range(SAVE_MAX_RETRIES):
+        blob_data, etag = storage.read(store, name)
+        updated = mutate(deserialize(blob_data) if blob_data else None)
+        try:
+            new_etag = storage.write(store, name, serialize(updated), etag=etag or "*")
+            record_save_metric("writes")
+            return updated, new_etag
+        except ConflictError:
+            record_save_metric("conflicts")
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    record_save_metric("exhausted")
+    raise RuntimeError(f"Gave up on {name} after {SAVE_MAX_RETRIES} conflicting writes")
+
+
+def same_message(a, b):
+    return a["role"] == b["role"] and a["content"] == b["content"]
+
+
+def merge_messages(stored, local):
+    # Keep whatever another session appended and add this session's new turns after it
+    common = 0
+    while common < min(len(stored), len(local)) and same_message(stored[common], local[common]):
+        common += 1
+    if common == len(stored):
+        return local
+    if common == len(local):
+        return stored
+    return stored + local[common:]
+
+
+# Each turn only appends the new messages to an append blob next to the
+# conversation snapshot; the log is folded into the snapshot periodically
+CONVERSATION_LOG_COMPACTION_BLOCKS = int(os.getenv("CONVERSATION_LOG_COMPACTION_BLOCKS", "20"))
+
+
+@st.cache_resource(show_spinner=False)
+def get_persisted_counts():
+    # (username, conversation_id) -> number of messages already in storage
+    return {}
+
+
+def replay_conversation_log(messages, log_data):
+    for line in log_data.splitlines():
+        if line.strip():
+            batch = orjson.loads(line)
+            messages = merge_messages(messages, messages[:batch["seq"]] + batch["messages"])
+    return messages
+
+
+def read_conversation(username, conversation_id):
+    snapshot_data, _ = storage.read(CONVERSATION_STORE, conversation_blob_name(username, conversation_id))
+    log_data, log_etag = storage.read(CONVERSATION_STORE, conversation_log_name(username, conversation_id))
+    if snapshot_data is None and log_data is None:
+        return None, None
+
+    conversation = deserialize(snapshot_data) if snapshot_data else {"id": conversation_id, "messages": []}
+    if log_data:
+        conversation["messages"] = replay_conversation_log(conversation["messages"], log_data)
+    return conversation, log_etag
+
+
+# Recently opened conversations stay in a per-process LRU cache, and the most
+# recent ones in the sidebar are prefetched in the background
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "256"))
+CONVERSATION_CACHE_TTL = int(os.getenv("CONVERSATION_CACHE_TTL", "600"))
+CONVERSATION_PREFETCH_COUNT = int(os.getenv("CONVERSATION_PREFETCH_COUNT", "3"))
+
+
+@st.cache_resource(show_spinner=False)
+def get_conversation_cache():
+    return {
+        "conversations": cachetools.TTLCache(maxsize=CONVERSATION_CACHE_SIZE, ttl=CONVERSATION_CACHE_TTL),
+        "prefetching": set(),
+        "executor": ThreadPoolExecutor(max_workers=2, thread_name_prefix="conversation-prefetch"),
+        "lock": threading.Lock(),
+    }
+
+
+def cache_conversation(username, conversation):
+    cache = get_conversation_cache()
+    with cache["lock"]:
+        cache["conversations"][(username, conversation["id"])] = copy.deepcopy(conversation)
+
+
+def get_cached_conversation(username, conversation_id):
+    cache = get_conversation_cache()
+    with cache["lock"]:
+        conversation = cache["conversations"].get((username, conversation_id))
+    return copy.deepcopy(conversation) if conversation else None
+
+
+def fetch_conversation(username, conversation_id):
+    conversation, _ = read_conversation(username, conversation_id)
+    if conversation:
+        get_persisted_counts()[(username, conversation_id)] = len(conversation["messages"])
+        cache_conversation(username, conversation)
+    return conversation
+
+
+def load_conversation(username, conversation_id):
+    pending = conversation_writer.pending_conversation(username, conversation_id)
+    if pending is not None:
+        return {"id": conversation_id, "messages": pending}
+    cached = get_cached_conversation(username, conversation_id)
+    if cached is not None:
+        return cached
+    try:
+        conversation = fetch_conversation(username, conversation_id)
+        if conversation is None:
+            conversation = rehydrate_conversation(username, conversation_id)
+        return copy.deepcopy(conversation)
+    except Exception as e:
+        st.error("Failed to load conversation.")
+        logging.error(f"Load Conversation Error: {e}")
+        return None
+
+
+def prefetch_conversations(username, index):
+    cache = get_conversation_cache()
+
+    def prefetch(conversation_id):
+        try:
+            fetch_conversation(username, conversation_id)
+        except Exception as e:
+            logging.error(f"Prefetch Conversation Error: {e}")
+        finally:
+            with cache["lock"]:
+                cache["prefetching"].discard((username, conversation_id))
+
+    for convo in reversed(index[-CONVERSATION_PREFETCH_COUNT:]):
+        key = (username, convo["id"])
+        with cache["lock"]:
+            if key in cache["conversations"] or key in cache["prefetching"]:
+                continue
+            cache["prefetching"].add(key)
+        cache["executor"].submit(prefetch, convo["id"])
+
+
+def append_conversation_log(username, conversation_id, conversation):
+    persisted_counts = get_persisted_counts()
+    key = (username, conversation_id)
+    seq = min(persisted_counts.get(key, 0), len(conversation))
+    if seq == len(conversation):
+        return 0
+
+    line = orjson.dumps({"seq": seq, "messages": conversation[seq:]}) + b"\n"
+    block_count = storage.append(CONVERSATION_STORE, conversation_log_name(username, conversation_id), line)
+    persisted_counts[key] = len(conversation)
+    return block_count
+
+
+def compact_conversation(username, conversation_id):
+    conversation, log_etag = read_conversation(username, conversation_id)
+    if conversation is None or log_etag is None:
+        return
+
+    def update_snapshot(stored):
+        if stored is None:
+            return conversation
+        stored["messages"] = merge_messages(stored["messages"], conversation["messages"])
+        return stored
+
+    update_blob(CONVERSATION_STORE, conversation_blob_name(username, conversation_id), update_snapshot)
+    try:
+        # Only drop the log if nobody appended to it since it was read
+        storage.delete(CONVERSATION_STORE, conversation_log_name(username, conversation_id), etag=log_etag)
+    except ConflictError:
+        pass
+
+
+def delete_conversation(username, conversation_id):
+    storage.delete(CONVERSATION_STORE, conversation_blob_name(username, conversation_id))
+    storage.delete(CONVERSATION_STORE, conversation_log_name(username, conversation_id))
+    storage.delete(CONVERSATION_STORE, conversation_summary_name(username, conversation_id))
+    get_persisted_counts().pop((username, conversation_id), None)
+    cache = get_conversation_cache()
+    with cache["lock"]:
+        cache["conversations"].pop((username, conversation_id), None)
+
+
+def upsert_index_entry(index, username, conversation_id, conversation):
+    # Index entries carry everything the sidebar and usage reports need, so
+    # message bodies are only downloaded when a conversation is opened
+    now = datetime.datetime.now().isoformat()
+    entry = next((convo for convo in index if convo["id"] == conversation_id), None)
+    if entry is None:
+        entry = {"id": conversation_id, "owner": username, "timestamp": now, "created": now}
+        index.append(entry)
+    entry.update({
+        "updated": now,
+        "title": get_conversation_title({"messages": conversation}),
+        "message_count": len(conversation),
+        "token_count": count_conversation_tokens(conversation),
+    })
+    return entry
+
+
+# Retention: each user keeps at most CONVERSATION_HOT_LIMIT conversations in hot
+# storage, and anything not updated for CONVERSATION_ARCHIVE_AFTER_DAYS is moved
+# into a gzip'd JSONL bundle on a cooler tier. Archived conversations are listed
+# in a separate archive index and rehydrated into hot storage when opened.
+# Nothing is archived until at least CONVERSATION_ARCHIVE_BATCH conversations
+# qualify, so bundles hold many conversations and most saves skip the pass; hot
+# storage may exceed either limit by up to that many conversations meanwhile.
+CONVERSATION_HOT_LIMIT = int(os.getenv("CONVERSATION_HOT_LIMIT", "30"))
+CONVERSATION_ARCHIVE_AFTER_DAYS = int(os.getenv("CONVERSATION_ARCHIVE_AFTER_DAYS", "30"))
+CONVERSATION_ARCHIVE_BATCH = int(os.getenv("CONVERSATION_ARCHIVE_BATCH", "10"))
+ARCHIVE_BLOB_TIER = os.getenv("ARCHIVE_BLOB_TIER", "Cool")
+
+
+def get_last_updated(entry):
+    return datetime.datetime.fromisoformat(entry.get("updated", entry["timestamp"]))
+
+
+def select_conversations_to_archive(index):
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=CONVERSATION_ARCHIVE_AFTER_DAYS)
+    by_age = sorted(index, key=get_last_updated)
+    overflow = by_age[:max(0, len(index) - CONVERSATION_HOT_LIMIT)]
+    stale = [entry for entry in by_age if get_last_updated(entry) < cutoff]
+    archive_ids = {entry["id"] for entry in overflow + stale}
+    if len(archive_ids) < CONVERSATION_ARCHIVE_BATCH:
+        return []
+    return [entry for entry in index if entry["id"] in archive_ids]
+
+
+def load_archive_index(username):
+    try:
+        blob_data, _ = storage.read(CONVERSATION_STORE, archive_index_blob_name(username))
+        return deserialize(blob_data) if blob_data else []
+    except Exception as e:
+        st.error("Failed to load archived conversations.")
+        logging.error(f"Load Archive Index Error: {e}")
+        return []
+
+
+def archive_conversations(username, entries):
+    bundle_name = f"archive/{username}/{datetime.datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}.jsonl.gz"
+    lines = []
+    for entry in entries:
+        conversation, _ = read_conversation(username, entry["id"])
+        if conversation:
+            lines.append(orjson.dumps(conversation))
+    if lines:
+        storage.write(CONVERSATION_STORE, bundle_name, gzip.compress(b"\n".join(lines)), tier=ARCHIVE_BLOB_TIER)
+
+    archive_ids = {entry["id"] for entry in entries}
+
+    def add_to_archive(archive_index):
+        archive_index = [entry for entry in archive_index or [] if entry["id"] not in archive_ids]
+        archive_index.extend(dict(entry, archived=bundle_name) for entry in entries)
+        return archive_index
+
+    def remove_from_index(index):
+        return [entry for entry in index or [] if entry["id"] not in archive_ids]
+
+    # Write the bundle and archive index before touching hot storage so a
+    # failure part-way never loses a conversation
+    update_blob(CONVERSATION_STORE, archive_index_blob_name(username), add_to_archive)
+    index, etag = update_blob(CONVERSATION_STORE, index_blob_name(username), remove_from_index)
+    cache_conversation_index(username, index, etag)
+    for conversation_id in archive_ids:
+        delete_conversation(username, conversation_id)
+    logging.info(f"Archived {len(archive_ids)} conversations for {username} to {bundle_name}")
+
+
+def rehydrate_conversation(username, conversation_id):
+    archive_index = load_archive_index(username)
+    entry = next((convo for convo in archive_index if convo["id"] == conversation_id), None)
+    if entry is None:
+        return None
+
+    bundle_data, _ = storage.read(CONVERSATION_STORE, entry["archived"])
+    conversation = None
+    for line in gzip.decompress(bundle_data).splitlines() if bundle_data else []:
+        candidate = orjson.loads(line)
+        if candidate["id"] == conversation_id:
+            conversation = candidate
+            break
+    if conversation is None:
+        return None
+
+    def restore_snapshot(stored):
+        if stored is None:
+            return conversation
+        stored["messages"] = merge_messages(stored["messages"], conversation["messages"])
+        return stored
+
+    def add_to_index(index):
+        index = [convo for convo in index or [] if convo["id"] != conversation_id]
+        restored = {key: value for key, value in entry.items() if key != "archived"}
+        restored["updated"] = datetime.datetime.now().isoformat()
+        index.append(restored)
+        return index
+
+    def remove_from_archive(archive_index):
+        return [convo for convo in archive_index or [] if convo["id"] != conversation_id]
+
+    update_blob(CONVERSATION_STORE, conversation_blob_name(username, conversation_id), restore_snapshot)
+    index, etag = update_blob(CONVERSATION_STORE, index_blob_name(username), add_to_index)
+    cache_conversation_index(username, index, etag)
+    update_blob(CONVERSATION_STORE, archive_index_blob_name(username), remove_from_archive)
+    return fetch_conversation(username, conversation_id)
+
+
+def persist_conversation(username, conversation_id, conversation):
+    block_count = append_conversation_log(username, conversation_id, conversation)
+
+    def update_index(index):
+        index = index or []
+        upsert_index_entry(index, username, conversation_id, conversation)
+        return index
+
+    index, etag = update_blob(CONVERSATION_STORE, index_blob_name(username), update_index)
+    cache_conversation_index(username, index, etag)
+    if block_count >= CONVERSATION_LOG_COMPACTION_BLOCKS:
+        compact_conversation(username, conversation_id)
+
+    # The conversation is already saved; a failed retention pass is retried on the next save
+    try:
+        to_archive = select_conversations_to_archive(index)
+        if to_archive:
+            archive_conversations(username, to_archive)
+    except Exception as e:
+        logging.error(f"Conversation Archive Error: {e}")
+
+
+# Saves are handed to a per-process background writer so the chat turn does not
+# wait on blob storage; rapid saves of one conversation collapse into one write
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "2"))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "3"))
+
+
+class ConversationWriter:
+    def __init__(self, interval):
+        self.interval = interval
+        self.save = None
+        self.pending = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="conversation-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def enqueue(self, username, conversation_id, conversation):
+        with self.lock:
+            # Copied so later token memoization on the session's dicts can't race the writer
+            self.pending[(username, conversation_id)] = (copy.deepcopy(conversation), 0)
+
+    def pending_conversation(self, username, conversation_id):
+        with self.lock:
+            pending = self.pending.get((username, conversation_id))
+        return list(pending[0]) if pending else None
+
+    def pop_failures(self, username):
+        with self.lock:
+            return self.failures.pop(username, [])
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            for (username, conversation_id), (conversation, attempts) in pending.items():
+                try:
+                    self.save(username, conversation_id, conversation)
+                except Exception as e:
+                    logging.error(f"Save Conversation Error: {e}")
+                    with self.lock:
+                        if attempts + 1 < WRITE_BEHIND_MAX_ATTEMPTS:
+                            # A newer save of the same conversation supersedes this retry
+                            self.pending.setdefault((username, conversation_id), (conversation, attempts + 1))
+                        else:
+                            # Only reported once the save is given up on
+                            self.failures.setdefault(username, []).append(conversation_id)
+
+
+@st.cache_resource(show_spinner=False)
+def get_conversation_writer():
+    return ConversationWriter(WRITE_BEHIND_FLUSH_INTERVAL)
+
+
+conversation_writer = get_conversation_writer()
+# Rebind on every run so the writer always uses the current storage clients
+conversation_writer.save = persist_conversation
+
+
+def save_conversation(username, conversation_id, conversation):
+    conversation_writer.enqueue(username, conversation_id, conversation)
+    cache_conversation(username, {"id": conversation_id, "messages": conversation})
+    # Show the change in the sidebar right away, before the writer flushes it
+    index = load_conversation_index(username)
+    upsert_index_entry(index, username, conversation_id, conversation)
+    cache_conversation_index(username, index)
+
+
+def append_message(role, content):
+    # Tokenize once on append and keep a running total for O(1) budget checks
+    message = {"role": role, "content": content}
+    st.session_state.token_total = st.session_state.get("token_total", 0) + get_token_counter(st.session_state.model)(message)
+    st.session_state.messages.append(message)
+
+
+def open_conversation(username, conversation_id):
+    conversation = load_conversation(username, conversation_id)
+    st.session_state.messages = conversation["messages"] if conversation else []
+    st.session_state.token_total = count_conversation_tokens(st.session_state.messages, st.session_state.model)
+    set_uploaded_document("")
+    st.session_state.conversation_id = conversation_id
+    st.rerun()
+
+
+# Turns that no longer fit the context window are folded into a running summary
+# that is sent as a system message instead. The summary records how many turns
+# it covers, so only newly dropped turns are summarized, and it is stored next
+# to the conversation.
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "500"))
+SUMMARY_INPUT_TOKENS = int(os.getenv("SUMMARY_INPUT_TOKENS", "6000"))
+SUMMARY_PROMPT = (
+    "You maintain a concise running summary of a conversation between a user and an assistant. "
+    "Update the existing summary with the new turns, keeping facts, decisions, names, numbers "
+    "and open questions the assistant may need later. Reply with the updated summary only."
+)
+
+
+def load_conversation_summary(username, conversation_id):
+    cached = st.session_state.get("conversation_summary")
+    if cached and cached["id"] == conversation_id:
+        return cached
+    summary = {"id": conversation_id, "summary": "", "covered": 0}
+    try:
+        blob_data, _ = storage.read(CONVERSATION_STORE, conversation_summary_name(username, conversation_id))
+        if blob_data:
+            summary.update(deserialize(blob_data))
+    except Exception as e:
+        logging.error(f"Load Summary Error: {e}")
+    st.session_state.conversation_summary = summary
+    return summary
+
+
+def summarize_turns(summary, turns, model):
+    count_tokens = get_token_counter(model)
+    batch, batch_tokens = [], 0
+    for msg in turns + [None]:
+        if msg is not None and (not batch or batch_tokens + count_tokens(msg) <= SUMMARY_INPUT_TOKENS):
+            batch.append(msg)
+            batch_tokens += count_tokens(msg)
+            continue
+        transcript = "\n\n".join(f"{turn['role']}: {turn['content']}" for turn in batch)
+        response = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"},
+            ],
+            max_tokens=SUMMARY_MAX_TOKENS,
+            temperature=0,
+        )
+        summary = response.choices[0].message.content or summary
+        if msg is not None:
+            batch, batch_tokens = [msg], count_tokens(msg)
+    return summary
+
+
+def apply_rolling_summary(messages, model, username, conversation_id, total_tokens=None):
+    fitted = fit_messages_to_context(messages, model, reserve_tokens=SUMMARY_MAX_TOKENS + 20, total_tokens=total_tokens)
+    history = [msg for msg in messages if msg["role"] != "system"]
+    dropped = len(history) - sum(1 for msg in fitted if msg["role"] != "system")
+    if dropped == 0:
+        return fitted
+
+    summary = load_conversation_summary(username, conversation_id)
+    if dropped > summary["covered"]:
+        try:
+            summary["summary"] = summarize_turns(summary["summary"], history[summary["covered"]:dropped], model)
+            summary["covered"] = dropped
+            storage.write(CONVERSATION_STORE, conversation_summary_name(username, conversation_id),
+                          serialize({"summary": summary["summary"], "covered": dropped}))
+        except Exception as e:
+            logging.error(f"Summarize Conversation Error: {e}")
+    if not summary["summary"]:
+        return fitted
+
+    summary_message = {"role": "system", "content": f"Summary of the earlier part of this conversation:\n{summary['summary']}"}
+    system_count = sum(1 for msg in fitted if msg["role"] == "system")
+    return fitted[:system_count] + [summary_message] + fitted[system_count:]
+
+
+# Streamed replies are buffered and re-rendered at most every
+# STREAM_RENDER_INTERVAL seconds or STREAM_RENDER_CHARS new characters,
+# instead of once per token
+STREAM_RENDER_INTERVAL = float(os.getenv("STREAM_RENDER_INTERVAL", "0.1"))
+STREAM_RENDER_CHARS = int(os.getenv("STREAM_RENDER_CHARS", "200"))
+
+
+class StreamRenderer:
+    def __init__(self, placeholder, interval=STREAM_RENDER_INTERVAL, chars=STREAM_RENDER_CHARS):
+        self.placeholder = placeholder
+        self.interval = interval
+        self.chars = chars
+        self.parts = []
+        self.pending_chars = 0
+        self.last_render = time.monotonic()
+
+    def add(self, token):
+        self.parts.append(token)
+        self.pending_chars += len(token)
+        if self.pending_chars >= self.chars or time.monotonic() - self.last_render >= self.interval:
+            self.render(cursor=True)
+
+    def render(self, cursor=False):
+        text = "".join(self.parts)
+        self.parts = [text]
+        self.placeholder.markdown(text + "▌" if cursor else text)
+        self.pending_chars = 0
+        self.last_render = time.monotonic()
+        return text
+
+    def text(self):
+        return "".join(self.parts)
+
+    def finish(self):
+        return self.render()
+
+
+# Replies are streamed by AsyncAzureOpenAI on one event loop per process. The
+# script thread only drains a token queue, and every session keeps a handle to
+# its in-flight completion so it can be cancelled (stop button, rerun or the
+# session going away), which closes the upstream stream immediately.
+COMPLETION_POLL_INTERVAL = float(os.getenv("COMPLETION_POLL_INTERVAL", "0.25"))
+
+
+@st.cache_resource(show_spinner=False)
+def get_completion_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="completion-loop", daemon=True).start()
+    return loop
+
+
+class CompletionHandle:
+    def __init__(self, async_client, loop, request):
+        self.queue = queue.Queue()
+        self.future = asyncio.run_coroutine_threadsafe(self.run(async_client, request), loop)
+
+    async def run(self, async_client, request):
+        stream = None
+        try:
+            stream = await async_client.chat.completions.create(stream=True, **request)
+            async for chunk in stream:
+                choices = getattr(chunk, 'choices', None)
+                if choices:
+                    delta = getattr(choices[0], 'delta', None)
+                    token = getattr(delta, 'content', '') if delta else ''
+                    if token:
+                        self.queue.put(token)
+        finally:
+            if stream is not None:
+                await stream.close()
+            self.queue.put(None)
+
+    def tokens(self, on_idle=None):
+        # Streamlit only notices a stop or rerun at its next st.* call, so while no
+        # token arrives on_idle is called every COMPLETION_POLL_INTERVAL to give it one
+        while True:
+            try:
+                token = self.queue.get(timeout=COMPLETION_POLL_INTERVAL)
+            except queue.Empty:
+                if self.future.done() and self.queue.empty():
+                    break  # Cancelled before the request started
+                if on_idle is not None:
+                    on_idle()
+                continue
+            if token is None:
+                break
+            yield token
+        self.future.result()  # Re-raise any API error
+
+    def cancel(self):
+        if not self.future.done():
+            self.future.cancel()
+
+
+def start_completion(request):
+    cancel_completion()
+    async_client = get_async_openai_client(azure_openai_api_key, azure_endpoint, OPENAI_API_VERSION)
+    handle = CompletionHandle(async_client, get_completion_loop(), request)
+    st.session_state.completion_handle = handle
+    return handle
+
+
+def cancel_completion():
+    handle = st.session_state.get("completion_handle")
+    if handle is not None:
+        handle.cancel()
+        st.session_state.completion_handle = None
+
+
+# Exact-match response cache: replies are keyed on a hash of the model settings,
+# the normalized messages actually sent and the uploaded document's fingerprint.
+# Entries live in a per-process TTL/LRU cache and, with RESPONSE_CACHE_PERSIST,
+# also in the storage backend so other workers can reuse them.
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_PERSIST = os.getenv("RESPONSE_CACHE_PERSIST", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_STORE = os.getenv("RESPONSE_CACHE_STORE", "response-cache")
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    return {
+        "responses": cachetools.TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL),
+        "executor": ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache"),
+        "hits": 0,
+        "misses": 0,
+        "lock": threading.Lock(),
+    }
+
+
+def response_cache_key(request, document_fingerprint=""):
+    normalized = [{"role": msg["role"], "content": " ".join((msg["content"] or "").split())}
+                  for msg in request["messages"]]
+    payload = orjson.dumps({
+        "model": request["model"],
+        "temperature": request["temperature"],
+        "max_tokens": request["max_tokens"],
+        "messages": normalized,
+        "document": document_fingerprint,
+    }, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+
+def record_response_cache_lookup(hit):
+    cache = get_response_cache()
+    with cache["lock"]:
+        cache["hits" if hit else "misses"] += 1
+        lookups = cache["hits"] + cache["misses"]
+        hit_rate = cache["hits"] / lookups
+    logging.info(f"Response cache {'hit' if hit else 'miss'} (hit rate {hit_rate:.1%} over {lookups} lookups)")
+
+
+def get_cached_response(key):
+    cache = get_response_cache()
+    with cache["lock"]:
+        response = cache["responses"].get(key)
+    if response is None and RESPONSE_CACHE_PERSIST:
+        try:
+            blob_data, _ = storage.read(RESPONSE_CACHE_STORE, f"responses/{key}.json")
+            if blob_data:
+                entry = deserialize(blob_data)
+                if time.time() - entry["created"] < RESPONSE_CACHE_TTL:
+                    response = entry["response"]
+                    with cache["lock"]:
+                        cache["responses"][key] = response
+        except Exception as e:
+            logging.error(f"Response Cache Read Error: {e}")
+    record_response_cache_lookup(response is not None)
+    return response
+
+
+def cache_response(key, response):
+    cache = get_response_cache()
+    with cache["lock"]:
+        cache["responses"][key] = response
+    if RESPONSE_CACHE_PERSIST:
+        def persist():
+            try:
+                storage.write(RESPONSE_CACHE_STORE, f"responses/{key}.json",
+                              serialize({"response": response, "created": time.time()}))
+            except Exception as e:
+                logging.error(f"Response Cache Write Error: {e}")
+        cache["executor"].submit(persist)
+
+
+def replay_response(response, chunk_size=20):
+    # Feed a cached reply through the same renderer as a live stream
+    for start in range(0, len(response), chunk_size):
+        yield response[start:start + chunk_size]
+
+
+# Semantic response cache: the first question of a conversation is embedded and
+# looked up in a FAISS inner-product index scoped to the user and uploaded
+# document; a cached answer is reused when the cosine similarity reaches
+# SEMANTIC_CACHE_THRESHOLD. Enabled when AZURE_EMBEDDING_DEPLOYMENT is set.
+EMBEDDING_DEPLOYMENT = os.getenv("AZURE_EMBEDDING_DEPLOYMENT", "")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+
+
+def embed_texts(texts):
+    response = client.embeddings.create(model=EMBEDDING_DEPLOYMENT, input=texts)
+    vectors = np.array([item.embedding for item in response.data], dtype="float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_cache():
+    return {"scopes": {}, "lookups": 0, "hits": 0, "saved_tokens": 0, "lock": threading.Lock()}
+
+
+def semantic_cache_lookup(scope, vector):
+    cache = get_semantic_cache()
+    with cache["lock"]:
+        entry = cache["scopes"].get(scope)
+        if entry is None or entry["index"].ntotal == 0:
+            return None
+        scores, ids = entry["index"].search(vector, 1)
+        if scores[0][0] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        return entry["responses"][ids[0][0]]
+
+
+def semantic_cache_add(scope, vector, response, response_tokens):
+    cache = get_semantic_cache()
+    with cache["lock"]:
+        entry = cache["scopes"].get(scope)
+        if entry is None:
+            entry = {"index": faiss.IndexFlatIP(vector.shape[1]), "vectors": [], "responses": []}
+            cache["scopes"][scope] = entry
+        if len(entry["responses"]) >= SEMANTIC_CACHE_MAX_ENTRIES:
+            # Drop the oldest half and rebuild; flat indexes don't support removal by age
+            keep = len(entry["responses"]) // 2
+            entry["vectors"] = entry["vectors"][keep:]
+            entry["responses"] = entry["responses"][keep:]
+            entry["index"] = faiss.IndexFlatIP(vector.shape[1])
+            entry["index"].add(np.stack(entry["vectors"]))
+        entry["index"].add(vector)
+        entry["vectors"].append(vector[0])
+        entry["responses"].append({"response": response, "tokens": response_tokens})
+
+
+def record_semantic_cache_lookup(hit, saved_tokens=0):
+    cache = get_semantic_cache()
+    with cache["lock"]:
+        cache["lookups"] += 1
+        cache["hits"] += int(hit)
+        cache["saved_tokens"] += saved_tokens
+        hit_rate = cache["hits"] / cache["lookups"]
+        total_saved = cache["saved_tokens"]
+    logging.info(f"Semantic cache {'hit' if hit else 'miss'} (hit rate {hit_rate:.1%}, {total_saved} tokens saved)")
+
+
+# Extracted text and chunk embeddings are cached by the SHA-256 of the uploaded
+# file's bytes, in a per-process LRU cache and in DOCUMENT_STORE, so a document
+# that anyone has uploaded before is never parsed or embedded again. The LRU cache
+# is bounded by the size of what it holds rather than by entry count.
+DOCUMENT_CACHE_MB = int(os.getenv("DOCUMENT_CACHE_MB", "256"))
+
+
+def document_size(document):
+    # Chunk segments are lists of strings; documents hold text or embeddings
+    if isinstance(document, list):
+        return sum(len(chunk) for chunk in document)
+    embeddings = document.get("embeddings")
+    return len(document.get("text", "")) + (embeddings["vectors"].nbytes if embeddings else 0)
+
+
+@st.cache_resource(show_spinner=False)
+def get_document_cache():
+    return {
+        "documents": cachetools.LRUCache(maxsize=DOCUMENT_CACHE_MB * 1024 * 1024, getsizeof=document_size),
+        "executor": ThreadPoolExecutor(max_workers=1, thread_name_prefix="document-cache"),
+        "lock": threading.Lock(),
+    }
+
+
+def document_blob_name(file_hash):
+    return f"extracted/{file_hash}.json"
+
+
+def encode_vectors(vectors):
+    return {"shape": list(vectors.shape), "data": base64.b64encode(vectors.astype(np.float32).tobytes()).decode("ascii")}
+
+
+def decode_vectors(encoded):
+    return np.frombuffer(base64.b64decode(encoded["data"]), dtype=np.float32).reshape(encoded["shape"])
+
+
+def remember_document(key, document):
+    cache = get_document_cache()
+    with cache["lock"]:
+        if document_size(document) <= cache["documents"].maxsize:
+            cache["documents"][key] = document
+
+
+def load_cached_document(file_hash):
+    cache = get_document_cache()
+    with cache["lock"]:
+        document = cache["documents"].get(file_hash)
+    if document is not None:
+        return document
+    try:
+        blob_data, _ = storage.read(DOCUMENT_STORE, document_blob_name(file_hash))
+        if not blob_data:
+            return None
+        document = deserialize(blob_data)
+        if document.get("embeddings"):
+            document["embeddings"]["vectors"] = decode_vectors(document["embeddings"]["vectors"])
+    except Exception as e:
+        logging.error(f"Document Cache Read Error: {e}")
+        return None
+    remember_document(file_hash, document)
+    return document
+
+
+def cache_document(file_hash, document):
+    cache = get_document_cache()
+    remember_document(file_hash, document)
+    stored = dict(document)
+    if document.get("embeddings"):
+        stored["embeddings"] = dict(document["embeddings"], vectors=encode_vectors(document["embeddings"]["vectors"]))
+    data = serialize(stored)
+
+    def persist():
+        try:
+            storage.write(DOCUMENT_STORE, document_blob_name(file_hash), data)
+        except Exception as e:
+            logging.error(f"Document Cache Write Error: {e}")
+    cache["executor"].submit(persist)
+
+
+# Uploaded documents are split into overlapping chunks, embedded and kept in a
+# per-session FAISS index; each question only sends the RAG_TOP_K most relevant
+# chunks. Without an embedding deployment the whole document is sent as before.
+RAG_CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "1000"))
+RAG_CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "150"))
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "4"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# Uploads are read and indexed incrementally: chunk text is written to
+# DOCUMENT_STORE in segments of EMBEDDING_BATCH_SIZE chunks and the session only
+# keeps the FAISS index. A session's document (index or plain text) may not grow
+# past DOCUMENT_MEMORY_LIMIT_MB; anything beyond that is left out.
+DOCUMENT_MEMORY_LIMIT_MB = int(os.getenv("DOCUMENT_MEMORY_LIMIT_MB", "32"))
+DOCUMENT_MEMORY_LIMIT = DOCUMENT_MEMORY_LIMIT_MB * 1024 * 1024
+TEXT_READ_SIZE = 64 * 1024
+SUPPORTED_UPLOAD_TYPES = (
+    "application/pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "text/plain",
+)
+
+
+def document_segment_blob_name(file_hash, segment):
+    return f"chunks/{file_hash}/{segment}.json"
+
+
+def document_index_settings():
+    # Anything that changes the chunks or their vectors invalidates cached embeddings
+    return [EMBEDDING_DEPLOYMENT, RAG_CHUNK_SIZE, RAG_CHUNK_OVERLAP, EMBEDDING_BATCH_SIZE, DOCUMENT_MEMORY_LIMIT]
+
+
+def iter_upload_text(uploaded_file, progress):
+    if uploaded_file.type == "application/pdf":
+        for page_number, page_count, page_text in pdf_extraction.iter_pdf_pages(uploaded_file.getvalue()):
+            progress.progress((page_number + 1) / page_count, text=f"Reading page {page_number + 1} of {page_count}...")
+            yield page_text + "\n"
+    elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+        for para in docx.Document(uploaded_file).paragraphs:
+            yield para.text + "\n"
+    else:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        uploaded_file.seek(0)
+        read = 0
+        while block := uploaded_file.read(TEXT_READ_SIZE):
+            read += len(block)
+            progress.progress(min(read / max(uploaded_file.size, 1), 1.0), text="Reading file...")
+            yield decoder.decode(block)
+        yield decoder.decode(b"", final=True)
+
+
+def iter_text_chunks(pieces):
+    # Splits a stream of text without holding all of it: the last chunk of each
+    # window is carried over so chunks never end at an arbitrary window boundary
+    splitter = text_splitters.RecursiveCharacterTextSplitter(chunk_size=RAG_CHUNK_SIZE, chunk_overlap=RAG_CHUNK_OVERLAP)
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        if len(buffer) >= RAG_CHUNK_SIZE * 4:
+            chunks = splitter.split_text(buffer)
+            yield from chunks[:-1]
+            buffer = chunks[-1] if chunks else ""
+    if buffer.strip():
+        yield from splitter.split_text(buffer)
+
+
+def read_document_text(pieces):
+    # Returns (text, truncated) with text capped at DOCUMENT_MEMORY_LIMIT characters
+    parts = []
+    size = 0
+    for piece in pieces:
+        if size + len(piece) > DOCUMENT_MEMORY_LIMIT:
+            parts.append(piece[:DOCUMENT_MEMORY_LIMIT - size])
+            return "".join(parts), True
+        parts.append(piece)
+        size += len(piece)
+    return "".join(parts), False
+
+
+def ingest_document(file_hash, pieces):
+    # Returns (document_index, truncated); document_index is None for empty documents
+    index = None
+    truncated = False
+
+    def add_segment(batch):
+        nonlocal index
+        vectors = embed_texts(batch)
+        if index is None:
+            index = faiss.IndexFlatIP(vectors.shape[1])
+        storage.write(DOCUMENT_STORE, document_segment_blob_name(file_hash, index.ntotal // EMBEDDING_BATCH_SIZE), serialize(batch))
+        index.add(vectors)
+
+    batch = []
+    for chunk in iter_text_chunks(pieces):
+        batch.append(chunk)
+        if len(batch) < EMBEDDING_BATCH_SIZE:
+            continue
+        add_segment(batch)
+        batch = []
+        if (index.ntotal + EMBEDDING_BATCH_SIZE) * index.d * 4 > DOCUMENT_MEMORY_LIMIT:
+            truncated = True
+            break
+    if batch:
+        add_segment(batch)
+    if index is None:
+        return None, False
+
+    cache_document(file_hash, {"embeddings": {"settings": document_index_settings(), "truncated": truncated,
+                                              "vectors": index.reconstruct_n(0, index.ntotal)}})
+    return {"file_hash": file_hash, "index": index}, truncated
+
+
+def load_document_index(file_hash):
+    document = load_cached_document(file_hash)
+    embeddings = document.get("embeddings") if document else None
+    if not embeddings or embeddings["settings"] != document_index_settings():
+        return None, False
+    index = faiss.IndexFlatIP(embeddings["vectors"].shape[1])
+    index.add(embeddings["vectors"])
+    return {"file_hash": file_hash, "index": index}, embeddings["truncated"]
+
+
+def ingest_upload(uploaded_file, progress):
+    # Loads the upload into the session, reusing cached work for known files;
+    # returns True when the document was cut off at the memory limit
+    file_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    if EMBEDDING_DEPLOYMENT:
+        document_index, truncated = load_document_index(file_hash)
+        if document_index is None:
+            document_index, truncated = ingest_document(file_hash, iter_upload_text(uploaded_file, progress))
+        set_uploaded_document("", file_hash, document_index)
+        return truncated
+
+    document = load_cached_document(file_hash)
+    if document is None or "text" not in document:
+        text, truncated = read_document_text(iter_upload_text(uploaded_file, progress))
+        document = {"text": text, "truncated": truncated}
+        cache_document(file_hash, document)
+    set_uploaded_document(document["text"], file_hash)
+    return document["truncated"]
+
+
+def load_document_segment(file_hash, segment):
+    cache = get_document_cache()
+    with cache["lock"]:
+        chunks = cache["documents"].get((file_hash, segment))
+    if chunks is None:
+        blob_data, _ = storage.read(DOCUMENT_STORE, document_segment_blob_name(file_hash, segment))
+        if not blob_data:
+            raise LookupError(f"Missing chunk segment {segment} of document {file_hash}")
+        chunks = deserialize(blob_data)
+        remember_document((file_hash, segment), chunks)
+    return chunks
+
+
+def retrieve_document_chunks(document_index, query_vector, top_k=RAG_TOP_K):
+    index = document_index["index"]
+    _, ids = index.search(query_vector, min(top_k, index.ntotal))
+    # Keep document order so neighbouring excerpts read naturally
+    return [load_document_segment(document_index["file_hash"], i // EMBEDDING_BATCH_SIZE)[i % EMBEDDING_BATCH_SIZE]
+            for i in sorted(int(i) for i in ids[0] if i >= 0)]
+
+
+def set_uploaded_document(content, fingerprint="", document_index=None):
+    st.session_state.uploaded_file_content = content
+    st.session_state.document_fingerprint = fingerprint
+    st.session_state.document_index = document_index
+
+
 # Function to handle user authentication
 def authenticate_user(authentication_status, name, username):
     if authentication_status:
@@ -83,19 +1868,28 @@ def authenticate_user(authentication_status, name, username):
         otp_secret = user_data.get('otp_secret', "")
 
         if not otp_secret:
-            otp_secret = pyotp.random_base32()
+            new_secret = pyotp.random_base32()
+
+            def add_otp_secret(stored_config):
+                # Only this user's entry is touched; another worker may have enrolled them first
+                user_entry = stored_config['credentials']['usernames'][username]
+                if not user_entry.get('otp_secret'):
+                    user_entry['otp_secret'] = new_secret
+                return stored_config
+
+            updated_config = update_config(add_otp_secret)
+            otp_secret = updated_config['credentials']['usernames'][username]['otp_secret']
             config['credentials']['usernames'][username]['otp_secret'] = otp_secret
-            blob_client.upload_blob(yaml.dump(config), overwrite=True)
             st.session_state['otp_setup_complete'] = False
             st.session_state['show_qr_code'] = True
             logging.info(f"Generated new OTP secret for user {username}")
         else:
             st.session_state['otp_setup_complete'] = True
 
-        totp = pyotp.TOTP(otp_secret)
-        logging.info(f"Using OTP secret for user {username}")
-
         if not st.session_state.get('otp_verified', False):
+            totp = pyotp.TOTP(otp_secret)
+            logging.info(f"Using OTP secret for user {username}")
+
             if st.session_state.get('show_qr_code', False):
                 st.title("Welcome! 👋")
                 otp_uri = totp.provisioning_uri(name=user_data.get('email', ''), issuer_name="SynoGPT")
@@ -141,40 +1935,23 @@ with st.sidebar:
     if authentication_status and st.session_state.get('otp_verified', False):
         st.title("Conversations")
 
+        st.toggle("Reuse cached answers", value=True, key="use_response_cache",
+                  help="Turn off to always ask the model for a fresh answer.")
+
         if st.button("New Chat", key='new_chat_button'):
             st.session_state.messages = []
-            st.session_state.uploaded_file_content = ""
+            st.session_state.token_total = 0
+            set_uploaded_document("")
             st.session_state.conversation_id = str(uuid.uuid4())  # Reset conversation ID for new chat
 
-        def get_conversation_title(conversation):
-            for msg in conversation["messages"]:
-                if msg["role"] == "user":
-                    title = msg["content"].strip()
-                    return title[:28] + "..." if len(title) > 28 else title
-            return "Untitled Conversation"
-
-        def load_conversations():
-            try:
-                blob_client = blob_service_client.get_blob_client(container="test-container", blob="conversations.json")
-                if blob_client.exists():
-                    blob_data = blob_client.download_blob().readall()
-                    if not blob_data:
-                        return []
-                    return json.loads(blob_data)
-                return []
-            except Exception as e:
-                st.error("Failed to load conversations.")
-                logging.error(f"Load Conversations Error: {e}")
-                return []
-
-        conversations = load_conversations()
+        conversations = load_conversation_index(username)
+        prefetch_conversations(username, conversations)
         today, yesterday, previous_7_days, previous_30_days = [], [], [], []
         now = datetime.datetime.now()
 
         for idx, convo in enumerate(reversed(conversations)):
             try:
-                timestamp = datetime.datetime.fromisoformat(convo["timestamp"])
-                delta = now - timestamp
+                delta = now - get_last_updated(convo)
                 if delta.days == 0:
                     today.append((idx, convo))
                 elif delta.days == 1:
@@ -189,42 +1966,39 @@ with st.sidebar:
         if today:
             st.subheader("Today")
             for idx, convo in today:
-                title = get_conversation_title(convo)
+                title = convo.get("title", "Untitled Conversation")
                 if st.button(title, key=f"today_{idx}"):
-                    st.session_state.messages = convo["messages"]
-                    st.session_state.uploaded_file_content = ""
-                    st.session_state.conversation_id = convo["id"]
-                    st.rerun()
+                    open_conversation(username, convo["id"])
 
         if yesterday:
             st.subheader("Yesterday")
             for idx, convo in yesterday:
-                title = get_conversation_title(convo)
+                title = convo.get("title", "Untitled Conversation")
                 if st.button(title, key=f"yesterday_{idx}"):
-                    st.session_state.messages = convo["messages"]
-                    st.session_state.uploaded_file_content = ""
-                    st.session_state.conversation_id = convo["id"]
-                    st.rerun()
+                    open_conversation(username, convo["id"])
 
         if previous_7_days:
             st.subheader("Previous 7 Days")
             for idx, convo in previous_7_days:
-                title = get_conversation_title(convo)
+                title = convo.get("title", "Untitled Conversation")
                 if st.button(title, key=f"week_{idx}"):
-                    st.session_state.messages = convo["messages"]
-                    st.session_state.uploaded_file_content = ""
-                    st.session_state.conversation_id = convo["id"]
-                    st.rerun()
+                    open_conversation(username, convo["id"])
 
         if previous_30_days:
             st.subheader("Previous 30 Days")
             for idx, convo in previous_30_days:
-                title = get_conversation_title(convo)
+                title = convo.get("title", "Untitled Conversation")
                 if st.button(title, key=f"month_{idx}"):
-                    st.session_state.messages = convo["messages"]
-                    st.session_state.uploaded_file_content = ""
-                    st.session_state.conversation_id = convo["id"]
-                    st.rerun()
+                    open_conversation(username, convo["id"])
+
+        if st.button("Archived", key='show_archived_button'):
+            st.session_state['show_archived'] = not st.session_state.get('show_archived', False)
+
+        if st.session_state.get('show_archived', False):
+            for idx, convo in enumerate(reversed(load_archive_index(username))):
+                title = convo.get("title", "Untitled Conversation")
+                if st.button(title, key=f"archived_{idx}"):
+                    open_conversation(username, convo["id"])
 
         st.markdown("---")
         st.markdown(f'## Hello, *{name}*')
@@ -244,6 +2018,10 @@ with st.sidebar:
 if authenticate_user(authentication_status, name, username):
     st.title("Synoptek-GPT! 🤖")
 
+    # Report background saves that failed since the last rerun
+    if conversation_writer.pop_failures(username):
+        st.error("Failed to save conversation.")
+
     if "messages" not in st.session_state:
         st.session_state.messages = []
 
@@ -251,10 +2029,13 @@ if authenticate_user(authentication_status, name, username):
         st.session_state.conversation_id = str(uuid.uuid4())  # Generate a unique conversation ID for the first time
 
     if "model" not in st.session_state:
-        st.session_state.model = "gpt-4o"
+        st.session_state.model = DEFAULT_MODEL
+
+    if "token_total" not in st.session_state:
+        st.session_state.token_total = count_conversation_tokens(st.session_state.messages, st.session_state.model)
 
     if "uploaded_file_content" not in st.session_state:
-        st.session_state.uploaded_file_content = ""
+        set_uploaded_document("")
 
     # Display the welcome image and message, but hide them once the user starts typing
     welcome_placeholder = st.empty()  # Placeholder for the welcome message and image
@@ -291,77 +2072,106 @@ if authenticate_user(authentication_status, name, username):
     if user_prompt:
         welcome_placeholder.empty()  # Hide the image and message
 
-        st.session_state.messages.append({"role": "user", "content": user_prompt})
+        append_message("user", user_prompt)
+        total_tokens = st.session_state.token_total
+        document_fingerprint = st.session_state.get("document_fingerprint", "")
+        prompt_vector = None
 
-        if st.session_state.uploaded_file_content:
-            file_content = st.session_state.uploaded_file_content
+        file_content = st.session_state.uploaded_file_content
+        if st.session_state.get("document_index"):
+            try:
+                prompt_vector = embed_texts([user_prompt])
+                file_content = "\n\n---\n\n".join(retrieve_document_chunks(st.session_state.document_index, prompt_vector))
+            except Exception as e:
+                st.warning("Couldn't search the uploaded document; answering without it.")
+                logging.error(f"Document Retrieval Error: {e}")
+        if file_content:
             assistant_context = f"You are an assistant that helps the user based on the content of the uploaded document.\n\nDocument content:\n{file_content}\n\nNow answer the user's question based on the document."
             messages = [{"role": "system", "content": assistant_context}, *st.session_state.messages]
+            total_tokens = None
         else:
             messages = st.session_state.messages
+        messages = apply_rolling_summary(messages, st.session_state.model, username,
+                                         st.session_state.conversation_id, total_tokens=total_tokens)
 
         with st.chat_message("user"):
             st.markdown(user_prompt)
 
         with st.chat_message("assistant"):
+            stop_placeholder = st.empty()
             message_placeholder = st.empty()
+            renderer = StreamRenderer(message_placeholder)
             full_response = ""
+            completed = False
+
+            request = {
+                "model": st.session_state.model,
+                "messages": to_api_messages(messages),
+                "max_tokens": MAX_RESPONSE_TOKENS,
+                "temperature": 0.5,
+            }
+            cache_key = None
+            cached_response = None
+            semantic_scope = None
+            if st.session_state.get("use_response_cache", True):
+                cache_key = response_cache_key(request, document_fingerprint)
+                cached_response = get_cached_response(cache_key)
+
+                # Only opening questions are matched semantically; follow-ups depend on context
+                is_first_turn = sum(1 for msg in messages if msg["role"] != "system") == 1
+                if cached_response is None and EMBEDDING_DEPLOYMENT and is_first_turn:
+                    semantic_scope = (username, document_fingerprint)
+                    try:
+                        if prompt_vector is None:
+                            prompt_vector = embed_texts([user_prompt])
+                        match = semantic_cache_lookup(semantic_scope, prompt_vector)
+                        if match is not None:
+                            cached_response = match["response"]
+                            count_tokens = get_token_counter(st.session_state.model)
+                            saved_tokens = match["tokens"] + sum(count_tokens(msg) for msg in messages)
+                            record_semantic_cache_lookup(True, saved_tokens)
+                        else:
+                            record_semantic_cache_lookup(False)
+                    except Exception as e:
+                        logging.error(f"Semantic Cache Error: {e}")
 
             try:
-                stream = client.chat.completions.create(
-                    model=st.session_state.model,
-                    messages=messages,
-                    stream=True,
-                    max_tokens=4000,
-                    temperature=0.5,
-                )
-                for chunk in stream:
-                    choices = getattr(chunk, 'choices', None)
-                    if choices:
-                        choice = choices[0]
-                        delta = getattr(choice, 'delta', None)
-                        if delta:
-                            token = getattr(delta, 'content', '')
-                            if token:
-                                full_response += token
-                                message_placeholder.markdown(full_response + "▌")
-                message_placeholder.markdown(full_response)
+                if cached_response is not None:
+                    tokens = replay_response(cached_response)
+                else:
+                    handle = start_completion(request)
+                    # Clicking this reruns the script, which interrupts the loop below
+                    stop_placeholder.button("Stop generating", key="stop_generating_button")
+                    tokens = handle.tokens(on_idle=lambda: renderer.render(cursor=True))
+                for token in tokens:
+                    renderer.add(token)
+                full_response = renderer.finish()
+                completed = True
+                if cache_key and cached_response is None:
+                    cache_response(cache_key, full_response)
+                    if semantic_scope is not None and prompt_vector is not None:
+                        response_tokens = get_token_counter(st.session_state.model)({"role": "assistant", "content": full_response})
+                        semantic_cache_add(semantic_scope, prompt_vector, full_response, response_tokens)
             except Exception as e:
+                completed = True
                 st.error("An error occurred while generating the response.")
                 logging.error(f"API Error: {e}")
+                if isinstance(e, openai.AuthenticationError):
+                    reset_openai_client()
                 full_response = "I'm sorry, but I'm unable to process your request at the moment."
                 message_placeholder.markdown(full_response)
+            finally:
+                cancel_completion()
+                if not completed:
+                    # Stopped or navigated away: keep what was generated so far
+                    append_message("assistant", renderer.text())
+                    save_conversation(username, st.session_state.conversation_id, st.session_state.messages)
+            stop_placeholder.empty()
 
-        st.session_state.messages.append({"role": "assistant", "content": full_response})
+        append_message("assistant", full_response)
 
         # Save the conversation
-        def save_conversation(conversation_id, conversation):
-            try:
-                conversations = load_conversations()
-
-                existing_convo = next((convo for convo in conversations if convo["id"] == conversation_id), None)
-
-                if existing_convo:
-                    existing_convo["messages"] = conversation
-                else:
-                    conversations.append({
-                        "id": conversation_id,
-                        "timestamp": datetime.datetime.now().isoformat(),
-                        "messages": conversation
-                    })
-
-                # conversations = conversations[30:]  # Limit to last 30 conversations
-                if len(conversations) > 30:
-                    conversations.pop(0)  # Remove the last (oldest) 
-
-                conversations_json = json.dumps(conversations, indent=4)
-                blob_client = blob_service_client.get_blob_client(container="test-container", blob="conversations.json")
-                blob_client.upload_blob(conversations_json, overwrite=True)
-            except Exception as e:
-                st.error("Failed to save conversation.")
-                logging.error(f"Save Conversation Error: {e}")
-
-        save_conversation(st.session_state.conversation_id, st.session_state.messages)
+        save_conversation(username, st.session_state.conversation_id, st.session_state.messages)
 
 
     # Paperclip button for file upload
@@ -378,30 +2188,23 @@ if authenticate_user(authentication_status, name, username):
         uploaded_file = st.file_uploader("Upload a file", key="file_uploader", label_visibility="hidden")
         if uploaded_file is not None:
             try:
-                file_content = None
-                if uploaded_file.type == "application/pdf":
-                    pdf_reader = PyPDF2.PdfReader(uploaded_file)
-                    text = "".join([page.extract_text() for page in pdf_reader.pages])
-                    file_content = text
-                elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                    doc = docx.Document(uploaded_file)
-                    text = "\n".join([para.text for para in doc.paragraphs])
-                    file_content = text
-                elif uploaded_file.type == "text/plain":
-                    file_content = uploaded_file.read().decode('utf-8', errors='ignore')
-                else:
+                if uploaded_file.type not in SUPPORTED_UPLOAD_TYPES:
                     st.error("Unsupported file type.")
                     st.session_state.show_file_uploader = False
                     st.stop()
 
-                st.session_state.uploaded_file_content = file_content
+                progress = st.progress(0.0, text="Reading file...")
+                truncated = ingest_upload(uploaded_file, progress)
+                progress.empty()
                 st.session_state.show_file_uploader = False
                 st.success("File uploaded and processed successfully!")
+                if truncated:
+                    st.warning(f"Only the first part of this document was loaded; it is larger than the {DOCUMENT_MEMORY_LIMIT_MB} MB per-session limit.")
 
             except Exception as e:
                 st.error("Failed to process the uploaded file.")
                 st.session_state.show_file_uploader = False
-                st.session_state.uploaded_file_content = ""
+                set_uploaded_document("")
                 st.error(f"Error: {e}")
 
 else:
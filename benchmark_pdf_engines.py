@@ -0,0 +1,117 @@
+import sys
+import time
+import queue
+import difflib
+import argparse
+import multiprocessing
+from pathlib import Path
+
+import pdf_extraction
+
+# Compares the engines in pdf_extraction.PDF_ENGINES on a folder of sample PDFs:
+#   python benchmark_pdf_engines.py path/to/corpus [--engines pypdfium2 pdfplumber]
+# Fidelity is measured against <name>.txt next to each PDF when present, otherwise
+# against pdfminer's output. Each run happens in a fresh process so peak memory
+# is not inflated by earlier runs.
+
+
+def peak_memory_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+
+
+def run_engine(engine, path, results):
+    try:
+        data = Path(path).read_bytes()
+        baseline = peak_memory_mb()
+        started = time.perf_counter()
+        pages = [text for _, _, text in pdf_extraction.iter_pdf_pages(data, engine=engine, max_workers=1)]
+        elapsed = time.perf_counter() - started
+        results.put({"pages": len(pages), "seconds": elapsed, "memory_mb": peak_memory_mb() - baseline, "text": "".join(pages)})
+    except Exception as e:
+        results.put({"error": str(e)})
+
+
+def measure(engine, path, timeout):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_engine, args=(engine, path, results))
+    process.start()
+    try:
+        result = results.get(timeout=timeout)
+    except queue.Empty:
+        raise RuntimeError(f"no result after {timeout}s")
+    finally:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.kill()
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+
+def fidelity(text, reference):
+    # Word-level similarity so differences in line wrapping and spacing don't count
+    return difflib.SequenceMatcher(None, text.split(), reference.split(), autojunk=False).ratio()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PDF text extraction engines")
+    parser.add_argument("corpus", help="Folder of sample PDFs")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds allowed per engine and file")
+    parser.add_argument("--engines", nargs="+", choices=list(pdf_extraction.PDF_ENGINES), default=list(pdf_extraction.PDF_ENGINES))
+    args = parser.parse_args()
+
+    engines = [engine for engine in args.engines if pdf_extraction.engine_available(engine)]
+    files = sorted(Path(args.corpus).glob("*.pdf"))
+    if not engines or not files:
+        sys.exit("Nothing to benchmark: no installed engines or no PDFs in the corpus")
+
+    totals = {engine: {"pages": 0, "seconds": 0.0, "memory_mb": 0.0, "fidelity": []} for engine in engines}
+    for path in files:
+        print(f"{path.name}")
+        runs = {}
+        for engine in engines:
+            try:
+                runs[engine] = measure(engine, path, args.timeout)
+            except Exception as e:
+                print(f"  {engine:<12} failed: {e}")
+
+        reference_path = path.with_suffix(".txt")
+        if reference_path.exists():
+            reference = reference_path.read_text(encoding="utf-8", errors="ignore")
+        elif "pdfminer" in runs:
+            reference = runs["pdfminer"]["text"]
+        else:
+            reference = None
+
+        for engine, run in runs.items():
+            score = fidelity(run["text"], reference) if reference is not None else None
+            total = totals[engine]
+            total["pages"] += run["pages"]
+            total["seconds"] += run["seconds"]
+            total["memory_mb"] = max(total["memory_mb"], run["memory_mb"])
+            if score is not None:
+                total["fidelity"].append(score)
+            print(f"  {engine:<12} {run['pages'] / max(run['seconds'], 1e-9):8.1f} pages/s"
+                  f"  {run['memory_mb']:7.1f} MB"
+                  f"  fidelity {'n/a' if score is None else f'{score:.3f}'}")
+
+    print("\nSummary")
+    print(f"  {'engine':<12} {'pages/s':>8}  {'peak MB':>7}  fidelity")
+    for engine, total in totals.items():
+        if not total["pages"]:
+            continue
+        mean_fidelity = sum(total["fidelity"]) / len(total["fidelity"]) if total["fidelity"] else None
+        print(f"  {engine:<12} {total['pages'] / max(total['seconds'], 1e-9):8.1f}  {total['memory_mb']:7.1f}"
+              f"  {'n/a' if mean_fidelity is None else f'{mean_fidelity:.3f}'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import io
+import os
+import sys
+import time
+import queue
+import logging
+import importlib
+import importlib.util
+import contextlib
+import multiprocessing
+
+# Lives in its own module because worker processes must be able to import the
+# functions they run; anything defined inside the Streamlit script cannot be pickled.
+
+PDF_MAX_WORKERS = int(os.getenv("PDF_MAX_WORKERS", "0")) or max(1, (os.cpu_count() or 1) - 1)
+PDF_PAGE_TIME_BUDGET = float(os.getenv("PDF_PAGE_TIME_BUDGET", "10"))
+PDF_POLL_INTERVAL = 0.1
+# A pool whose workers keep dying during startup never starts a page; give up on it
+PDF_WORKER_START_TIMEOUT = float(os.getenv("PDF_WORKER_START_TIMEOUT", "60"))
+# Below this many pages the cost of starting workers outweighs the gain
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "20"))
+# "auto" picks per document; any key of PDF_ENGINES forces that engine
+PDF_ENGINE = os.getenv("PDF_ENGINE", "auto")
+# Pages sampled when deciding whether a document is table-heavy
+PDF_TABLE_SAMPLE_PAGES = int(os.getenv("PDF_TABLE_SAMPLE_PAGES", "3"))
+
+
+# Each engine opens the raw PDF bytes and returns (page_count, extract_page)
+def open_pypdfium2(data):
+    pdfium = importlib.import_module("pypdfium2")
+    document = pdfium.PdfDocument(data)
+
+    def extract_page(page_number):
+        page = document[page_number]
+        textpage = page.get_textpage()
+        try:
+            return textpage.get_text_bounded()
+        finally:
+            textpage.close()
+            page.close()
+    return len(document), extract_page
+
+
+def open_pdfplumber(data):
+    pdfplumber = importlib.import_module("pdfplumber")
+    document = pdfplumber.open(io.BytesIO(data))
+
+    def extract_page(page_number):
+        page = document.pages[page_number]
+        try:
+            return page.extract_text() or ""
+        finally:
+            page.close()  # Drops the page's cached layout objects
+    return len(document.pages), extract_page
+
+
+def open_pdfminer(data):
+    converter = importlib.import_module("pdfminer.converter")
+    layout = importlib.import_module("pdfminer.layout")
+    pdfinterp = importlib.import_module("pdfminer.pdfinterp")
+    pdfpage = importlib.import_module("pdfminer.pdfpage")
+    # The page tree is walked once and one interpreter renders every page
+    pages = list(pdfpage.PDFPage.get_pages(io.BytesIO(data)))
+    output = io.StringIO()
+    resources = pdfinterp.PDFResourceManager()
+    interpreter = pdfinterp.PDFPageInterpreter(resources, converter.TextConverter(resources, output, laparams=layout.LAParams()))
+
+    def extract_page(page_number):
+        output.seek(0)
+        output.truncate()
+        interpreter.process_page(pages[page_number])
+        return output.getvalue()
+    return len(pages), extract_page
+
+
+def open_pypdf(data):
+    reader = importlib.import_module("pypdf").PdfReader(io.BytesIO(data))
+    return len(reader.pages), lambda page_number: reader.pages[page_number].extract_text() or ""
+
+
+def open_pypdf2(data):
+    reader = importlib.import_module("PyPDF2").PdfReader(io.BytesIO(data))
+    return len(reader.pages), lambda page_number: reader.pages[page_number].extract_text() or ""
+
+
+# In order of preference when an engine is not installed
+PDF_ENGINES = {
+    "pypdfium2": open_pypdfium2,
+    "pdfplumber": open_pdfplumber,
+    "pdfminer": open_pdfminer,
+    "pypdf": open_pypdf,
+    "PyPDF2": open_pypdf2,
+}
+
+
+def engine_available(engine):
+    return importlib.util.find_spec(engine) is not None
+
+
+def is_table_heavy(data):
+    pdfplumber = importlib.import_module("pdfplumber")
+    with pdfplumber.open(io.BytesIO(data)) as document:
+        sample = document.pages[:PDF_TABLE_SAMPLE_PAGES]
+        pages_with_tables = sum(1 for page in sample if page.find_tables())
+    return bool(sample) and pages_with_tables * 2 >= len(sample)
+
+
+def select_engine(data, engine=None):
+    engine = engine or PDF_ENGINE
+    if engine != "auto":
+        if engine not in PDF_ENGINES:
+            raise ValueError(f"Unknown PDF engine: {engine}")
+        return engine
+    # pdfium is by far the fastest, but pdfplumber keeps table rows together
+    if engine_available("pdfplumber"):
+        try:
+            if is_table_heavy(data):
+                return "pdfplumber"
+        except Exception as e:
+            logging.warning(f"PDF table detection failed: {e}")
+    for candidate in PDF_ENGINES:
+        if engine_available(candidate):
+            return candidate
+    raise RuntimeError("No PDF extraction engine is installed")
+
+
+_worker_extract_page = None
+_worker_started = None
+
+
+def _init_worker(engine, data, started):
+    global _worker_extract_page, _worker_started
+    _, _worker_extract_page = PDF_ENGINES[engine](data)
+    _worker_started = started
+
+
+def _extract_page(page_number):
+    # Report when the page actually starts so its budget excludes time spent queued
+    _worker_started.put((page_number, time.time()))
+    return _worker_extract_page(page_number)
+
+
+def _drain_start_times(started):
+    start_times = {}
+    while True:
+        try:
+            page_number, started_at = started.get_nowait()
+        except queue.Empty:
+            return start_times
+        start_times[page_number] = started_at
+
+
+@contextlib.contextmanager
+def _without_main_script():
+    # Spawned children re-run the parent's __main__ file before anything else; under
+    # Streamlit that is the whole app (config, clients, writer thread). Hiding it
+    # while the workers start means they only import this module.
+    main_module = sys.modules.get("__main__")
+    main_file = getattr(main_module, "__file__", None)
+    if main_file is None:
+        yield
+        return
+    del main_module.__file__
+    try:
+        yield
+    finally:
+        main_module.__file__ = main_file
+
+
+def iter_pdf_pages(data, engine=None, max_workers=None, page_time_budget=None):
+    # Yields (page_number, page_count, text) in page order. A page that runs longer
+    # than the budget comes back empty; its worker can only be stopped by killing
+    # the pool, so pages that already finished are kept and the rest go to a new pool.
+    engine = select_engine(data, engine)
+    page_count, extract_page = PDF_ENGINES[engine](data)
+    logging.info(f"Extracting {page_count} PDF pages with {engine}")
+    max_workers = min(max_workers or PDF_MAX_WORKERS, page_count)
+    page_time_budget = page_time_budget or PDF_PAGE_TIME_BUDGET
+
+    if max_workers <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+        for page_number in range(page_count):
+            yield page_number, page_count, extract_page(page_number)
+        return
+
+    # spawn rather than fork: the app process runs writer and event-loop threads
+    # whose locks would be copied into the children
+    context = multiprocessing.get_context("spawn")
+    texts = {}
+    next_page = 0
+    while next_page < page_count:
+        started = context.Queue()
+        with _without_main_script():
+            pool = context.Pool(min(max_workers, page_count - next_page), initializer=_init_worker, initargs=(engine, data, started))
+        restart = False
+        pool_created = time.time()
+        try:
+            results = {page_number: pool.apply_async(_extract_page, (page_number,))
+                       for page_number in range(next_page, page_count) if page_number not in texts}
+            start_times = {}
+            while next_page < page_count and not restart:
+                if next_page not in texts:
+                    result = results[next_page]
+                    result.wait(PDF_POLL_INTERVAL)
+                    start_times.update(_drain_start_times(started))
+                    if result.ready():
+                        texts[next_page] = result.get()
+                    elif not start_times and time.time() - pool_created > PDF_WORKER_START_TIMEOUT:
+                        raise RuntimeError(f"PDF extraction workers did not start within {PDF_WORKER_START_TIMEOUT}s")
+                    elif time.time() - start_times.get(next_page, time.time()) > page_time_budget:
+                        logging.warning(f"PDF page {next_page + 1} exceeded its {page_time_budget}s extraction budget")
+                        texts[next_page] = ""
+                        texts.update({page_number: result.get() for page_number, result in results.items()
+                                      if page_number not in texts and result.ready()})
+                        restart = True
+                    else:
+                        continue
+                yield next_page, page_count, texts.pop(next_page)
+                next_page += 1
+        finally:
+            pool.terminate()